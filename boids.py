@@ -1,240 +1,491 @@
 import pygame
 import numpy as np
-from dataclasses import dataclass
 import math
-from collections import deque
 
 import argparse, sys
 
-@dataclass
-class Boid:
-    x: float
-    y: float
-    dx: float
-    dy: float
-    # Add a history of positions and velocities
-    position_history: deque  # Will store (x, y) tuples
-    velocity_history: deque  # Will store (dx, dy) tuples
+# Flocking rule parameters (the three rule factors are defaults, see BoidSimulation)
+CENTERING_FACTOR = 0.005  # cohesion: steer towards the neighbors' center
+MIN_DISTANCE = 20         # separation: keep at least this far from other boids
+AVOID_FACTOR = 0.05
+MATCHING_FACTOR = 0.05    # alignment: steer towards the neighbors' average velocity
+MARGIN = 200              # boids closer than this to an edge turn back
+TURN_FACTOR = 1
+SPEED_LIMIT = 10
+
+# Boid triangle for heading 0 and size 1: the nose, then the two rear corners at +-2.4 rad
+TRIANGLE = np.array([(2, 0), (math.cos(2.4), math.sin(2.4)), (math.cos(2.4), -math.sin(2.4))], dtype=np.float32)
+BOID_SIZE = 4
+HEADING_BINS = 64  # boid sprites are prerendered for this many headings
+
+# The NumPy backend switches from per-pair to per-cell neighbor search when the flock
+# averages more candidate pairs than this per occupied cell
+BLOCK_CANDIDATES_PER_CELL = 800
+
+def pairwise_sq_dist(p, q, out=None, xp=np):
+    """Squared distances between the rows of p (M, 2) and q (K, 2), as an (M, K) matrix.
+
+    Uses |p|^2 + |q|^2 - 2 p.q so no (M, K, 2) temporary is created. The result is written
+    to out when given; xp is the array module of p and q.
+    """
+    d2 = xp.matmul(p, q.T, out=out)
+    d2 *= -2
+    d2 += (p * p).sum(axis=1)[:, None]
+    d2 += (q * q).sum(axis=1)[None, :]
+    return xp.maximum(d2, 0, out=d2)
+
+def load_numba_kernel():
+    """Import the Numba flocking kernel from boids_numba.py; compiled on its first call."""
+    try:
+        import boids_numba
+    except ImportError as e:
+        raise ImportError("the numba backend requires the numba package") from e
+    return boids_numba.flock_kernel
+
+def load_cython_kernel():
+    """Compile (on first use) and import the Cython flocking kernel from boids_kernel.pyx."""
+    import pyximport
+    pyximport.install(language_level=3)
+    import boids_kernel
+    return boids_kernel.flock_kernel
 
 class BoidSimulation:
-    def __init__(self, width=1024, height=768, perception_delay=5, num_boids=100, vis_range=75):
+    def __init__(self, width=1024, height=768, perception_delay=5, num_boids=100, vis_range=75, backend='numpy',
+                 device='cpu', centering_factor=CENTERING_FACTOR, avoid_factor=AVOID_FACTOR,
+                 matching_factor=MATCHING_FACTOR):
+        # Compiled flocking kernel, or None for the NumPy implementation in flock()
+        self.backend = backend
+        self.kernel = None
+        if backend == 'numba':
+            self.kernel = load_numba_kernel()
+        elif backend == 'cython':
+            self.kernel = load_cython_kernel()
+
+        # Array module holding the simulation state: NumPy, or CuPy to run on the GPU
+        self.device = device
+        self.xp = np
+        self.to_host = np.asarray
+        if device == 'cuda':
+            if backend != 'numpy':
+                raise ValueError("the cuda device only supports the numpy backend")
+            try:
+                import cupy  # optional, only needed for --device=cuda
+            except ImportError as e:
+                raise ImportError("the cuda device requires the cupy package") from e
+            self.xp = cupy
+            self.to_host = cupy.asnumpy
+        xp = self.xp
+
         pygame.init()
         self.width = width
         self.height = height
         self.screen = pygame.display.set_mode((width, height))
         pygame.display.set_caption("Boids with Perception Delay")
         
-        self.boids = []
         self.num_boids = num_boids
         self.visual_range = vis_range
-        self.visual_range_sq = self.visual_range * self.visual_range  # squared visual range for comparisons
+        self.visual_range_sq = np.float32(self.visual_range * self.visual_range)  # squared visual range for comparisons
         self.cell_size = self.visual_range  # each cell is roughly the size of the visual range
+        self.ncols = max(1, math.ceil(width / self.cell_size))
+        self.nrows = max(1, math.ceil(height / self.cell_size))
         self.clock = pygame.time.Clock()
         
         # Perception delay (number of frames)
         self.perception_delay = perception_delay
 
+        # Weights of the cohesion, separation and alignment rules
+        self.k_coh = float(centering_factor)
+        self.k_sep = float(avoid_factor)
+        self.k_align = float(matching_factor)
+
         # Add a flag to toggle trajectory display
         self.show_trajectories = False
 
-        maxlen = perception_delay + 1
-        
-        # Initialize boids with random positions and velocities
-        for _ in range(self.num_boids):
-            # Initialize position and velocity history deques with initial values
-            position_history = deque(maxlen=100)  # Limit history to 100 steps
-            velocity_history = deque(maxlen=maxlen)  # Limit history to perception delay steps
-            
-            x = np.random.rand() * width
-            y = np.random.rand() * height
-            dx = np.random.rand() * 10 - 5
-            dy = np.random.rand() * 10 - 5
-            
-            # Fill history with initial position and velocity
-            for _ in range(self.perception_delay + 1):
-                position_history.append((x, y))
-                velocity_history.append((dx, dy))
-            
-            self.boids.append(Boid(
-                x=x,
-                y=y,
-                dx=dx,
-                dy=dy,
-                position_history=position_history,
-                velocity_history=velocity_history
-            ))
-    
-    def get_neighbors_with_delay(self, boid, grid):
-        """Return a list of neighboring boids (within visual range) using delayed position data."""
-        neighbors = []
-        current_cell_x = int(boid.x / self.cell_size)
-        current_cell_y = int(boid.y / self.cell_size)
+        # Font and the rendered delay text, which only changes with the perception delay
+        self.font = pygame.font.SysFont(None, 36)
+        self._delay_surf = None
+        self._delay_surf_key = -1
+
+        # Prerendered sprites: a boid triangle per heading bin, and the delayed position marker
+        self.boid_sprites = self.make_boid_sprites()
+        self.delay_marker = pygame.Surface((5, 5), pygame.SRCALPHA)
+        pygame.draw.circle(self.delay_marker, (255, 100, 100), (2, 2), 2)
+        self.delay_marker = self.delay_marker.convert_alpha()
+
+        # History lengths: positions keep 100 steps for trajectories, velocities only
+        # what the largest perception delay (10, or the initial delay) can look back
+        self.vel_maxlen = max(10, perception_delay) + 1
+        self.pos_maxlen = max(100, self.vel_maxlen)
         
-        # Check the boid's cell and all adjacent cells
-        for i in range(current_cell_x - 1, current_cell_x + 2):
-            for j in range(current_cell_y - 1, current_cell_y + 2):
-                if (i, j) in grid:
-                    for other in grid[(i, j)]:
-                        if other is not boid:
-                            # Use delayed position information
-                            if len(other.position_history) > self.perception_delay:
-                                delayed_x, delayed_y = other.position_history[-self.perception_delay]
-                                
-                                # Calculate distance using the delayed position
-                                dx = boid.x - delayed_x
-                                dy = boid.y - delayed_y
-                                
-                                if dx * dx + dy * dy < self.visual_range_sq:
-                                    neighbors.append((other, delayed_x, delayed_y, 
-                                                     other.velocity_history[-self.perception_delay]))
+        # Boid state is stored as arrays (structure of arrays): row i is boid i
+        self.pos = xp.asarray(np.random.rand(num_boids, 2).astype(np.float32) * np.array([width, height], dtype=np.float32))
+        self.vel = xp.asarray(np.random.rand(num_boids, 2).astype(np.float32) * 10 - 5)
+
+        # Preallocated ring buffers of past positions and velocities, shape (maxlen, N, 2),
+        # filled with the initial state. hist_idx counts the frames written so far and
+        # maps to slot hist_idx % maxlen in each buffer.
+        self.pos_hist = xp.empty((self.pos_maxlen, num_boids, 2), dtype=np.float32)
+        self.vel_hist = xp.empty((self.vel_maxlen, num_boids, 2), dtype=np.float32)
+        self.pos_hist[:] = self.pos
+        self.vel_hist[:] = self.vel
+        self.hist_idx = 0
+
+        # Scratch buffers reused every frame instead of reallocated
+        self._dv = xp.empty((num_boids, 2), dtype=np.float32)           # velocity change from the flocking rules
+        self._step = xp.empty((num_boids, 2), dtype=np.float32)         # elementwise temporary
+        self._bounds_mask = xp.empty((num_boids, 2), dtype=bool)
+        self._speed_sq = xp.empty(num_boids, dtype=np.float32)
+        self._upper_margin = xp.array([width - MARGIN, height - MARGIN], dtype=np.float32)
+        # Grid buffers, used on the CPU only
+        self._cell_f = np.empty((num_boids, 2), dtype=np.float32)       # grid coordinates before truncation
+        self._cell = np.empty((num_boids, 2), dtype=np.int32)           # grid cell of each boid
+        self._cell_id = np.empty(num_boids, dtype=np.int32)
+        if device == 'cuda':
+            self.allocate_dense_buffers()
+
+    def delayed_state(self):
+        """Return the (positions, velocities) from perception_delay frames back."""
+        t = self.hist_idx - self.perception_delay
+        return self.pos_hist[t % self.pos_maxlen], self.vel_hist[t % self.vel_maxlen]
+
+    def grid_cells(self, positions):
+        """Return the (cell_x, cell_y) grid cell of each position, as an (N, 2) int32 array.
+
+        Positions outside the arena are put in the nearest edge cell, which keeps every pair
+        within visual range in adjacent cells. The result is a scratch buffer, overwritten
+        by the next call.
+        """
+        cell = self._cell
+        np.copyto(cell, np.floor_divide(positions, self.cell_size, out=self._cell_f), casting='unsafe')
+        np.clip(cell[:, 0], 0, self.ncols - 1, out=cell[:, 0])
+        np.clip(cell[:, 1], 0, self.nrows - 1, out=cell[:, 1])
+        return cell
+
+    def build_grid(self, positions):
+        """Bucket boids into grid cells with a counting sort.
+
+        Returns (order, offsets): the boids in cell c are order[offsets[c]:offsets[c + 1]],
+        where c = cell_y * ncols + cell_x.
+        """
+        cell = self.grid_cells(positions)
+        cell_id = np.multiply(cell[:, 1], self.ncols, out=self._cell_id)
+        cell_id += cell[:, 0]
+
+        order = np.argsort(cell_id, kind='stable')
+        counts = np.bincount(cell_id, minlength=self.ncols * self.nrows)
+        offsets = np.concatenate([[0], counts.cumsum()])
+        return order, offsets
+
+    def candidate_slices(self, delayed_grid):
+        """Return (starts, lengths): each boid's candidate neighbors as slices of the delayed grid order.
+
+        A boid's candidates are the boids in its cell and all adjacent cells. Within a row of the
+        grid the three cells are one contiguous slice of delayed_order, so boid i has the three
+        slices starts[i, r]:starts[i, r] + lengths[i, r], one per row, each possibly empty.
+        """
+        _, delayed_offsets = delayed_grid
+
+        cell = self.grid_cells(self.pos)
+        first = np.maximum(cell[:, 0] - 1, 0)[:, None]
+        last = np.minimum(cell[:, 0] + 1, self.ncols - 1)[:, None]
+        rows = cell[:, 1, None] + np.arange(-1, 2)
+        valid_rows = (rows >= 0) & (rows < self.nrows)
+        rows = np.clip(rows, 0, self.nrows - 1) * self.ncols
+        starts = delayed_offsets[rows + first]
+        lengths = np.where(valid_rows, delayed_offsets[rows + last + 1] - starts, 0)
+        return starts, lengths
+
+    def get_neighbors_with_delay(self, delayed_grid, delayed_pos, delayed_vel, candidates):
+        """Return all (boid, neighbor) pairs within visual range, using delayed position data.
+
+        candidates comes from candidate_slices(delayed_grid). Returns (counts, pairs, d2), with
+        the pairs grouped by boid: boid i has counts[i] neighbors, and each row of pairs holds
+        the offset from the neighbor's delayed position to the boid's current position, then the
+        neighbor's delayed position and velocity. d2 is the squared length of the offset.
+        """
+        delayed_order, _ = delayed_grid
+        starts, lengths = candidates
+        n = self.num_boids
+
+        # Expand the (boid, row slice) ranges into one flat index into delayed_order
+        starts, lengths = starts.ravel(), lengths.ravel()
+        slice_begin = np.cumsum(lengths) - lengths
+        k = np.arange(lengths.sum()) + np.repeat(starts - slice_begin, lengths)
+        lengths = lengths.reshape(n, 3).sum(axis=1)
+
+        # One gather of the delayed state per candidate, from arrays already in grid order
+        delayed_state = np.concatenate([delayed_pos, delayed_vel], axis=1)[delayed_order]
+        pairs = np.empty((len(k), 6), dtype=np.float32)
+        pairs[:, 2:] = delayed_state[k]
+        np.subtract(np.repeat(self.pos, lengths, axis=0), pairs[:, 2:4], out=pairs[:, :2])
+
+        # Squared distances from the boids' current positions to the candidates' delayed
+        # positions; a boid is not its own neighbor
+        d2 = np.einsum('ij,ij->i', pairs[:, :2], pairs[:, :2])
+        pair_i = np.repeat(np.arange(n), lengths)
+        keep = (d2 < self.visual_range_sq) & (delayed_order[k] != pair_i)
+        counts = np.bincount(pair_i[keep], minlength=n)
+        return counts, pairs[keep], d2[keep]
+
+    def get_neighbor_blocks(self, grid, delayed_grid, delayed_pos):
+        """Yield (members, candidates, d2) for every occupied grid cell, using delayed position data.
+
+        members are the boids in the cell, candidates the boids in the 3x3 cells around it, and
+        d2 the (members, candidates) squared distances, with inf for a boid paired with itself.
+        grid buckets the boids by current position, delayed_grid by delayed position.
+        """
+        order, offsets = grid
+        delayed_order, delayed_offsets = delayed_grid
         
-        return neighbors
-
-    def keep_within_bounds(self, boid):
-        margin = 200
-        turn_factor = 1
-
-        if boid.x < margin:
-            boid.dx += turn_factor
-        if boid.x > self.width - margin:
-            boid.dx -= turn_factor
-        if boid.y < margin:
-            boid.dy += turn_factor
-        if boid.y > self.height - margin:
-            boid.dy -= turn_factor
-
-    def fly_towards_center(self, boid, neighbors):
-        centerX = 0
-        centerY = 0
-        num_neighbors = 0
-        centering_factor = 0.005
-
-        for other, delayed_x, delayed_y, _ in neighbors:
-            centerX += delayed_x
-            centerY += delayed_y
-            num_neighbors += 1
-
-        if num_neighbors:
-            centerX /= num_neighbors
-            centerY /= num_neighbors
-
-            boid.dx += (centerX - boid.x) * centering_factor
-            boid.dy += (centerY - boid.y) * centering_factor
-
-    def avoid_others(self, boid, neighbors):
-        min_distance = 20  
-        min_distance_sq = min_distance * min_distance
-        avoid_factor = 0.05 
-        moveX = 0
-        moveY = 0
-
-        for other, delayed_x, delayed_y, _ in neighbors:
-            dx = boid.x - delayed_x
-            dy = boid.y - delayed_y
-            if dx * dx + dy * dy < min_distance_sq:
-                moveX += dx
-                moveY += dy
-
-        boid.dx += moveX * avoid_factor
-        boid.dy += moveY * avoid_factor
-
-    def match_velocity(self, boid, neighbors):
-        matching_factor = 0.05
-        avgDX = 0
-        avgDY = 0
-        num_neighbors = 0
-
-        for other, _, _, delayed_velocity in neighbors:
-            delayed_dx, delayed_dy = delayed_velocity
-            avgDX += delayed_dx
-            avgDY += delayed_dy
-            num_neighbors += 1
-
-        if num_neighbors:
-            avgDX /= num_neighbors
-            avgDY /= num_neighbors
-
-            boid.dx += (avgDX - boid.dx) * matching_factor
-            boid.dy += (avgDY - boid.dy) * matching_factor
-
-    def limit_speed(self, boid):
-        speed_limit = 10
-        speed = math.sqrt(boid.dx * boid.dx + boid.dy * boid.dy)
-        if speed > speed_limit:
-            boid.dx = (boid.dx / speed) * speed_limit
-            boid.dy = (boid.dy / speed) * speed_limit
+        for cell_id in np.flatnonzero(offsets[1:] - offsets[:-1]):
+            cell_y, cell_x = divmod(int(cell_id), self.ncols)
+            members = order[offsets[cell_id]:offsets[cell_id + 1]]
+
+            # Candidates are the boids in this cell and all adjacent cells; within
+            # a row of the grid the three cells are one contiguous slice
+            first = max(cell_x - 1, 0)
+            last = min(cell_x + 1, self.ncols - 1)
+            candidates = np.concatenate([
+                delayed_order[delayed_offsets[row * self.ncols + first]:delayed_offsets[row * self.ncols + last + 1]]
+                for row in range(max(cell_y - 1, 0), min(cell_y + 1, self.nrows - 1) + 1)
+            ])
+
+            # Squared distances from the members' current positions to the
+            # candidates' delayed positions, measured from the cell origin
+            origin = np.array([cell_x, cell_y], dtype=np.float32) * self.cell_size
+            d2 = pairwise_sq_dist(self.pos[members] - origin, delayed_pos[candidates] - origin)
+            d2[members[:, None] == candidates[None, :]] = np.inf  # a boid is not its own neighbor
+            yield members, candidates, d2
+
+    def keep_within_bounds(self):
+        # +turn_factor below the lower margin, -turn_factor above the upper margin, per axis
+        xp = self.xp
+        below = xp.less(self.pos, MARGIN, out=self._bounds_mask)
+        self.vel += xp.multiply(below, TURN_FACTOR, out=self._step)
+        above = xp.greater(self.pos, self._upper_margin, out=self._bounds_mask)
+        self.vel -= xp.multiply(above, TURN_FACTOR, out=self._step)
+
+    def flock(self, neighbors):
+        """Return the velocity change from the three flocking rules, computed in one pass over the neighbor pairs.
+
+        Cohesion (fly towards the center of the neighbors), separation (avoid neighbors that
+        are too close) and alignment (match the neighbors' velocity) are each a sum over the
+        same pairs, so they are combined per pair and summed per boid once.
+        """
+        counts, pairs, d2 = neighbors
+        min_distance_sq = np.float32(MIN_DISTANCE * MIN_DISTANCE)
+
+        # Per pair: the cohesion and alignment terms, then the separation offset
+        terms = np.empty((len(pairs), 4), dtype=np.float32)
+        np.multiply(pairs[:, 2:4], self.k_coh, out=terms[:, :2])
+        terms[:, :2] += pairs[:, 4:] * self.k_align
+        np.multiply(pairs[:, :2], (d2 < min_distance_sq)[:, None], out=terms[:, 2:])
+
+        # The pairs are grouped by boid, so each boid's pairs are one contiguous run to sum
+        sums = np.zeros((self.num_boids, 4), dtype=np.float32)
+        seen = np.flatnonzero(counts)
+        if len(seen):
+            sums[seen] = np.add.reduceat(terms, (np.cumsum(counts) - counts)[seen], axis=0)
+
+        # 1 / count for boids with neighbors; boids without neighbors sum to zero anyway
+        counts = counts[:, None].astype(np.float32)
+        inv_counts = 1 / np.maximum(counts, 1)
+        has_neighbors = np.minimum(counts, 1)
+
+        dv = self._dv
+        np.multiply(sums[:, :2], inv_counts, out=dv)
+        dv += sums[:, 2:] * self.k_sep
+        dv -= (self.pos * self.k_coh + self.vel * self.k_align) * has_neighbors
+        return dv
+
+    def flock_blocks(self, blocks, delayed_pos, delayed_vel):
+        """Return the same velocity change as flock(), computed in one pass per cell.
+
+        Each block of get_neighbor_blocks is a small dense matrix, so the three rules become
+        mask @ X products over the same gathered data.
+        """
+        min_distance_sq = np.float32(MIN_DISTANCE * MIN_DISTANCE)
+
+        dv = self._dv
+        dv.fill(0)
+        for members, candidates, d2 in blocks:
+            mask = d2 < self.visual_range_sq
+            counts = mask.sum(axis=1, dtype=np.float32)
+            if not counts.any():
+                continue
+
+            # 1 / count for boids with neighbors and 0 for the others, so boids without
+            # neighbors get no velocity change without being filtered out
+            inv_counts = np.divide(1, counts, out=np.zeros_like(counts), where=counts > 0)[:, None]
+            has_neighbors = counts[:, None] * inv_counts
+
+            pos = self.pos[members]
+            other_pos = delayed_pos[candidates]
+            center = (mask @ other_pos) * inv_counts
+            avg_vel = (mask @ delayed_vel[candidates]) * inv_counts
+            close = mask & (d2 < min_distance_sq)
+            separation = close.sum(axis=1, dtype=np.float32)[:, None] * pos - close @ other_pos
+
+            dv[members] = (self.k_coh * (center - pos * has_neighbors)
+                           + self.k_sep * separation
+                           + self.k_align * (avg_vel - self.vel[members] * has_neighbors))
+        return dv
+
+    def allocate_dense_buffers(self):
+        """Allocate the (N, N) scratch matrices flock_dense() writes into every frame."""
+        xp = self.xp
+        n = self.num_boids
+        self._d2 = xp.empty((n, n), dtype=np.float32)        # squared distances, then the neighbor mask as float32
+        self._close_f = xp.empty((n, n), dtype=np.float32)   # the separation mask as float32
+        self._mask = xp.empty((n, n), dtype=bool)
+        self._close = xp.empty((n, n), dtype=bool)
+
+    def flock_dense(self, delayed_pos, delayed_vel):
+        """Return the same velocity change as flock(), from the full (N, N) neighbor matrix.
+
+        No grid and no Python loop, only whole-array operations, which suits the GPU; the
+        memory and work grow with N^2, so the matrices are the buffers from
+        allocate_dense_buffers(). Written against self.xp so it runs on NumPy or CuPy.
+        """
+        xp = self.xp
+        min_distance_sq = np.float32(MIN_DISTANCE * MIN_DISTANCE)
+
+        # Squared distances from every boid to every delayed position, measured from the
+        # arena center to keep the float32 error small
+        origin = xp.array([self.width / 2, self.height / 2], dtype=np.float32)
+        d2 = pairwise_sq_dist(self.pos - origin, delayed_pos - origin, out=self._d2, xp=xp)
+        xp.fill_diagonal(d2, xp.inf)  # a boid is not its own neighbor
+
+        neighbor = xp.less(d2, self.visual_range_sq, out=self._mask)
+        close = xp.less(d2, min_distance_sq, out=self._close)
+        xp.logical_and(close, neighbor, out=close)
+        # The distances are no longer needed, so their buffer takes the float neighbor mask
+        mask = self._d2
+        xp.copyto(mask, neighbor)
+        close_f = self._close_f
+        xp.copyto(close_f, close)
+
+        counts = mask.sum(axis=1, keepdims=True)
+        inv_counts = 1 / xp.maximum(counts, 1)  # boids without neighbors sum to zero anyway
+        has_neighbors = xp.minimum(counts, 1)
+
+        center = (mask @ delayed_pos) * inv_counts
+        avg_vel = (mask @ delayed_vel) * inv_counts
+        separation = close_f.sum(axis=1, keepdims=True) * self.pos - close_f @ delayed_pos
+
+        return (self.k_coh * (center - self.pos * has_neighbors)
+                + self.k_sep * separation
+                + self.k_align * (avg_vel - self.vel * has_neighbors))
+
+    def limit_speed(self):
+        # Compare squared speeds; only the boids over the limit need a square root
+        xp = self.xp
+        speed_sq = xp.multiply(self.vel, self.vel, out=self._step).sum(axis=1, out=self._speed_sq)
+        too_fast = speed_sq > SPEED_LIMIT * SPEED_LIMIT
+        self.vel[too_fast] *= (SPEED_LIMIT / xp.sqrt(speed_sq[too_fast]))[:, None]
 
     # Ensure the circle's center is within screen bounds, considering its radius
-    def clamp_circle(self, x, y, radius):
-        x = max(radius, min(self.width - radius, x))
-        y = max(radius, min(self.height - radius, y))
-        return x, y
+    def clamp_circle(self, centers, radius):
+        return np.clip(centers, radius, [self.width - radius, self.height - radius])
 
     def update_boids(self):
-        # Build a spatial grid (a dictionary mapping (cell_x, cell_y) -> list of boids)
-        grid = {}
-        for boid in self.boids:
-            cell = (int(boid.x / self.cell_size), int(boid.y / self.cell_size))
-            if cell not in grid:
-                grid[cell] = []
-            grid[cell].append(boid)
-        
+        # Snapshot of what the boids perceive: the state perception_delay frames back
+        delayed_pos, delayed_vel = self.delayed_state()
+
         # Update each boid using only nearby boids (neighbors) with delay
-        for boid in self.boids:
-            neighbors = self.get_neighbors_with_delay(boid, grid)
-            self.fly_towards_center(boid, neighbors)
-            self.avoid_others(boid, neighbors)
-            self.match_velocity(boid, neighbors)
-            self.keep_within_bounds(boid)
-            self.limit_speed(boid)
-
-            # Update position
-            boid.x += boid.dx
-            boid.y += boid.dy
-            
-            # Update position and velocity history
-            boid.position_history.append((boid.x, boid.y))
-            boid.velocity_history.append((boid.dx, boid.dy))
+        if self.device == 'cuda':
+            self.vel += self.flock_dense(delayed_pos, delayed_vel)
+        elif self.kernel is not None:
+            # Spatial grid of the delayed positions
+            delayed_grid = self.build_grid(delayed_pos)
+            self.vel += self.kernel(self.pos, self.vel, delayed_pos, delayed_vel, *delayed_grid,
+                                    self.ncols, self.nrows, self.cell_size, self.visual_range_sq,
+                                    np.float32(MIN_DISTANCE * MIN_DISTANCE), self.k_coh, self.k_sep, self.k_align,
+                                    self._dv)
+        else:
+            delayed_grid = self.build_grid(delayed_pos)
+            candidates = self.candidate_slices(delayed_grid)
+            occupied_cells = np.count_nonzero(np.diff(delayed_grid[1]))
+            if candidates[1].sum() > BLOCK_CANDIDATES_PER_CELL * occupied_cells:
+                # Crowded cells: dense per-cell products beat expanding every pair
+                grid = self.build_grid(self.pos)
+                blocks = self.get_neighbor_blocks(grid, delayed_grid, delayed_pos)
+                self.vel += self.flock_blocks(blocks, delayed_pos, delayed_vel)
+            else:
+                neighbors = self.get_neighbors_with_delay(delayed_grid, delayed_pos, delayed_vel, candidates)
+                self.vel += self.flock(neighbors)
+        self.keep_within_bounds()
+        self.limit_speed()
+
+        # Update positions
+        self.pos += self.vel
+        
+        # Update position and velocity history
+        self.pos_hist[self.hist_idx % self.pos_maxlen] = self.pos
+        self.vel_hist[self.hist_idx % self.vel_maxlen] = self.vel
+        self.hist_idx += 1
+
+    def make_boid_sprites(self):
+        """Render the boid triangle once for each of HEADING_BINS headings, centered on its surface."""
+        half = int(math.ceil(2 * BOID_SIZE)) + 1
+        sprites = []
+        for k in range(HEADING_BINS):
+            angle = 2 * math.pi * k / HEADING_BINS
+            cos_a, sin_a = math.cos(angle), math.sin(angle)
+            points = [(half + cos_a * x - sin_a * y, half + sin_a * x + cos_a * y) for x, y in (TRIANGLE * BOID_SIZE).tolist()]
+            sprite = pygame.Surface((2 * half + 1, 2 * half + 1), pygame.SRCALPHA)
+            pygame.draw.polygon(sprite, (85, 140, 244), points)
+            sprites.append(sprite.convert_alpha())
+        return sprites
+
+    def draw_trajectories(self, num_bands=10):
+        """Draw each boid's position history, fading out towards the oldest positions.
+
+        The history is split into num_bands consecutive stretches that each get one color,
+        so every boid costs num_bands polyline calls instead of one call per segment.
+        """
+        # Positions in chronological order, oldest first: (maxlen, N, 2)
+        trajectories = self.to_host(self.xp.roll(self.pos_hist, -(self.hist_idx % self.pos_maxlen), axis=0))
+        num_points = len(trajectories)
+        bounds = np.linspace(0, num_points - 1, num_bands + 1).round().astype(int)
+
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if end <= start:
+                continue
+            # Calculate the fade color
+            fade_factor = end / num_points
+            color = (int(100 * fade_factor), int(255 * fade_factor), int(100 * fade_factor))
+            # Consecutive bands share their end point so the polylines join up
+            for points in trajectories[start:end + 1].transpose(1, 0, 2).tolist():
+                pygame.draw.lines(self.screen, color, False, points, 1)
 
     def draw(self):
         self.screen.fill((0, 0, 0))
+
+        # Draw the trajectories if the flag is set
+        if self.show_trajectories:
+            self.draw_trajectories()
+
+        # Host copies of the state for drawing
+        pos = self.to_host(self.pos)
+        vel = self.to_host(self.vel)
+        delayed_pos = self.to_host(self.delayed_state()[0])
         
-        for boid in self.boids:
-            angle = math.atan2(boid.dy, boid.dx)
-            size = 4
-            
-            # Draw the boid as a triangle
-            points = [
-                (boid.x + math.cos(angle) * size * 2,
-                 boid.y + math.sin(angle) * size * 2),
-                (boid.x + math.cos(angle + 2.4) * size,
-                 boid.y + math.sin(angle + 2.4) * size),
-                (boid.x + math.cos(angle - 2.4) * size,
-                 boid.y + math.sin(angle - 2.4) * size)
-            ]
-            pygame.draw.polygon(self.screen, (85, 140, 244), points)
-            
-            # Optionally visualize the delayed position that other boids perceive
-            if len(boid.position_history) >= self.perception_delay:
-                delayed_x, delayed_y = boid.position_history[-self.perception_delay]
-                delayed_x, delayed_y = self.clamp_circle(delayed_x, delayed_y, 2)
-                pygame.draw.circle(self.screen, (255, 100, 100), (int(delayed_x), int(delayed_y)), 2)
-            
-            # Draw the trajectory if the flag is set
-            if self.show_trajectories and len(boid.position_history) > 1:
-                points = list(boid.position_history)
-                for i in range(1, len(points)):
-                    start_pos = points[i - 1]
-                    end_pos = points[i]
-                    # Calculate the fade color
-                    fade_factor = i / len(points)
-                    color = (int(100 * fade_factor), int(255 * fade_factor), int(100 * fade_factor))
-                    pygame.draw.line(self.screen, color, start_pos, end_pos, 1)
+        # Draw each boid as the sprite for its heading, rounded to the nearest bin, then
+        # the delayed positions that other boids perceive, all in one batched blit call
+        heading = np.rint(np.arctan2(vel[:, 1], vel[:, 0]) * (HEADING_BINS / (2 * np.pi))).astype(int) % HEADING_BINS
+        half = self.boid_sprites[0].get_width() // 2
+        corners = (np.rint(pos) - half).astype(int).tolist()
+        delayed_corners = (self.clamp_circle(delayed_pos, 2).astype(int) - 2).tolist()
+        sprites = self.boid_sprites
+        self.screen.blits([(sprites[k], corner) for k, corner in zip(heading.tolist(), corners)]
+                          + [(self.delay_marker, corner) for corner in delayed_corners], doreturn=False)
 
         # Display the current perception delay on screen
-        font = pygame.font.SysFont(None, 36)
-        delay_text = font.render(f"Perception Delay: {self.perception_delay} frames", True, (255, 255, 255))
-        self.screen.blit(delay_text, (10, 10))
+        if self._delay_surf_key != self.perception_delay:
+            self._delay_surf = self.font.render(f"Perception Delay: {self.perception_delay} frames", True, (255, 255, 255))
+            self._delay_surf_key = self.perception_delay
+        self.screen.blit(self._delay_surf, (10, 10))
 
         pygame.display.flip()
 
@@ -271,10 +522,17 @@ def main():
     cmd.add_argument('--height', type=int, default=768, help='arena height');
     cmd.add_argument('--num_boids', type=int, default=100, help='number of boids');
     cmd.add_argument('--vis_range', type=int, default=75, help='vis_range');
+    cmd.add_argument('--centering_factor', type=float, default=CENTERING_FACTOR, help='cohesion: steering towards the neighbors\' center');
+    cmd.add_argument('--avoid_factor', type=float, default=AVOID_FACTOR, help='separation: steering away from boids closer than %d' % MIN_DISTANCE);
+    cmd.add_argument('--matching_factor', type=float, default=MATCHING_FACTOR, help='alignment: steering towards the neighbors\' average velocity');
+    cmd.add_argument('--backend', choices=['numpy', 'numba', 'cython'], default='numpy', help='flocking rule implementation');
+    cmd.add_argument('--device', choices=['cpu', 'cuda'], default='cpu', help='cuda runs the numpy backend on the GPU with CuPy');
     args = cmd.parse_args()
 
     # set perception delay
-    sim = BoidSimulation(perception_delay=args.delay, width=args.width, height=args.height, num_boids=args.num_boids, vis_range=args.vis_range)
+    sim = BoidSimulation(perception_delay=args.delay, width=args.width, height=args.height, num_boids=args.num_boids, vis_range=args.vis_range,
+                         backend=args.backend, device=args.device, centering_factor=args.centering_factor,
+                         avoid_factor=args.avoid_factor, matching_factor=args.matching_factor)
     sim.run()
 
 if __name__ == "__main__":
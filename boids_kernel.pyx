@@ -0,0 +1,68 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""Cython/OpenMP implementation of the flocking rules, used by ``boids.py --backend=cython``.
+
+Compiled on first import through pyximport; the compiler flags are in boids_kernel.pyxbld.
+"""
+from cython.parallel import prange
+from libc.math cimport floor
+
+
+cdef inline void _flock_one(Py_ssize_t i, const float[:, ::1] pos, const float[:, ::1] vel,
+                            const float[:, ::1] delayed_pos, const float[:, ::1] delayed_vel,
+                            const Py_ssize_t[::1] cell_order, const Py_ssize_t[::1] cell_offsets,
+                            Py_ssize_t ncols, Py_ssize_t nrows, float cell_size,
+                            float visual_range_sq, float min_distance_sq, float centering_factor,
+                            float avoid_factor, float matching_factor, float[:, ::1] dv) noexcept nogil:
+    cdef float x = pos[i, 0]
+    cdef float y = pos[i, 1]
+    cdef Py_ssize_t cell_x = min(max(<Py_ssize_t>floor(x / cell_size), 0), ncols - 1)
+    cdef Py_ssize_t cell_y = min(max(<Py_ssize_t>floor(y / cell_size), 0), nrows - 1)
+    cdef Py_ssize_t first = max(cell_x - 1, 0)
+    cdef Py_ssize_t last = min(cell_x + 1, ncols - 1)
+    cdef Py_ssize_t row, k, j
+    cdef Py_ssize_t num_neighbors = 0
+    cdef float center_x = 0, center_y = 0, avg_dx = 0, avg_dy = 0, move_x = 0, move_y = 0
+    cdef float dx, dy, d2
+
+    for row in range(max(cell_y - 1, 0), min(cell_y + 1, nrows - 1) + 1):
+        for k in range(cell_offsets[row * ncols + first], cell_offsets[row * ncols + last + 1]):
+            j = cell_order[k]
+            if j == i:
+                continue
+            dx = x - delayed_pos[j, 0]
+            dy = y - delayed_pos[j, 1]
+            d2 = dx * dx + dy * dy
+            if d2 < visual_range_sq:
+                num_neighbors += 1
+                center_x += delayed_pos[j, 0]
+                center_y += delayed_pos[j, 1]
+                avg_dx += delayed_vel[j, 0]
+                avg_dy += delayed_vel[j, 1]
+                if d2 < min_distance_sq:
+                    move_x += dx
+                    move_y += dy
+
+    if num_neighbors:
+        dv[i, 0] = ((center_x / num_neighbors - x) * centering_factor + move_x * avoid_factor
+                    + (avg_dx / num_neighbors - vel[i, 0]) * matching_factor)
+        dv[i, 1] = ((center_y / num_neighbors - y) * centering_factor + move_y * avoid_factor
+                    + (avg_dy / num_neighbors - vel[i, 1]) * matching_factor)
+    else:
+        dv[i, 0] = 0
+        dv[i, 1] = 0
+
+
+def flock_kernel(const float[:, ::1] pos, const float[:, ::1] vel,
+                 const float[:, ::1] delayed_pos, const float[:, ::1] delayed_vel,
+                 const Py_ssize_t[::1] cell_order, const Py_ssize_t[::1] cell_offsets,
+                 Py_ssize_t ncols, Py_ssize_t nrows, float cell_size,
+                 float visual_range_sq, float min_distance_sq, float centering_factor,
+                 float avoid_factor, float matching_factor, out):
+    """Same arguments and result as boids_numba.flock_kernel: writes the (N, 2) velocity change into out."""
+    cdef float[:, ::1] dv = out
+    cdef Py_ssize_t i
+
+    for i in prange(pos.shape[0], nogil=True, schedule='static'):
+        _flock_one(i, pos, vel, delayed_pos, delayed_vel, cell_order, cell_offsets, ncols, nrows, cell_size,
+                   visual_range_sq, min_distance_sq, centering_factor, avoid_factor, matching_factor, dv)
+    return out
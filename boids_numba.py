@@ -0,0 +1,60 @@
+"""Numba implementation of the flocking rules, used by ``boids.py --backend=numba``.
+
+Imported only for that backend, so numba stays an optional dependency.
+"""
+import math
+
+import numba
+import numpy as np
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def flock_kernel(pos, vel, delayed_pos, delayed_vel, cell_order, cell_offsets, ncols, nrows, cell_size,
+                 visual_range_sq, min_distance_sq, centering_factor, avoid_factor, matching_factor, dv):
+    """Compiled equivalent of BoidSimulation.flock: one thread per boid walks its 3x3 grid cells.
+
+    The grid (cell_order, cell_offsets) buckets the boids by delayed position. Writes the
+    velocity change from the flocking rules into the (N, 2) array dv and returns it.
+    """
+    n = pos.shape[0]
+    for i in numba.prange(n):
+        x = pos[i, 0]
+        y = pos[i, 1]
+        cell_x = min(max(int(math.floor(x / cell_size)), 0), ncols - 1)
+        cell_y = min(max(int(math.floor(y / cell_size)), 0), nrows - 1)
+        first = max(cell_x - 1, 0)
+        last = min(cell_x + 1, ncols - 1)
+
+        num_neighbors = 0
+        center_x = 0.0
+        center_y = 0.0
+        avg_dx = 0.0
+        avg_dy = 0.0
+        move_x = 0.0
+        move_y = 0.0
+        for row in range(max(cell_y - 1, 0), min(cell_y + 1, nrows - 1) + 1):
+            for k in range(cell_offsets[row * ncols + first], cell_offsets[row * ncols + last + 1]):
+                j = cell_order[k]
+                if j == i:
+                    continue
+                dx = x - delayed_pos[j, 0]
+                dy = y - delayed_pos[j, 1]
+                d2 = dx * dx + dy * dy
+                if d2 < visual_range_sq:
+                    num_neighbors += 1
+                    center_x += delayed_pos[j, 0]
+                    center_y += delayed_pos[j, 1]
+                    avg_dx += delayed_vel[j, 0]
+                    avg_dy += delayed_vel[j, 1]
+                    if d2 < min_distance_sq:
+                        move_x += dx
+                        move_y += dy
+
+        if num_neighbors:
+            dv[i, 0] = ((center_x / num_neighbors - x) * centering_factor + move_x * avoid_factor
+                        + (avg_dx / num_neighbors - vel[i, 0]) * matching_factor)
+            dv[i, 1] = ((center_y / num_neighbors - y) * centering_factor + move_y * avoid_factor
+                        + (avg_dy / num_neighbors - vel[i, 1]) * matching_factor)
+        else:
+            dv[i, 0] = 0
+            dv[i, 1] = 0
+    return dv